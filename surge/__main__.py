@@ -4,18 +4,17 @@ import pathlib
 import secrets
 import sys
 
-try:
-    import uvloop
-except ImportError:
-    pass
-else:
-    uvloop.install()
-
 from .metadata import Metadata, yield_available_pieces
 from .protocol import download
 
 
 def main(args):
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
     with open(args.file, "rb") as f:
         metadata = Metadata.from_bytes(f.read())
     folder = args.output
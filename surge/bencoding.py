@@ -6,25 +6,31 @@ BEncoding is a serialization format that is used to exchange dictionary-like
 data with peers.
 
 This module provides the functions `decode` and `encode`, as well as the
-lower-level `decode_from` and `raw_val`.
+lower-level `decode_from`, `raw_val`, and `raw_span`.
 
 [BEP 0003]: http://bittorrent.org/beps/bep_0003.html
 """
 
-import io
+# Token values, computed once instead of calling `ord` for every token.
+_INT = ord("i")
+_LIST = ord("l")
+_DICT = ord("d")
+_END = ord("e")
+_ZERO = ord("0")
+_NINE = ord("9")
 
 
 def _decode_int(bs, start):
     # More lenient than the specification: ignores leading zeros instead of
     # raising an exception.
     end = bs.index(b"e", start)
-    return end + 1, int(bs[start + 1 : end].decode("ascii"))
+    return end + 1, int(bs[start + 1 : end])
 
 
 def _decode_list(bs, start):
     result = []
     start += 1
-    while bs[start] != ord("e"):
+    while bs[start] != _END:
         start, rval = decode_from(bs, start)
         result.append(rval)
     return start + 1, result
@@ -35,7 +41,7 @@ def _decode_dict(bs, start):
     # keys are sorted.
     result = {}
     start += 1
-    while bs[start] != ord("e"):
+    while bs[start] != _END:
         start, key = _decode_bytes(bs, start)
         start, result[key] = decode_from(bs, start)
     return start + 1, result
@@ -43,24 +49,26 @@ def _decode_dict(bs, start):
 
 def _decode_bytes(bs, start):
     sep_index = bs.index(b":", start)
-    end = sep_index + int(bs[start:sep_index].decode("ascii")) + 1
+    end = sep_index + int(bs[start:sep_index]) + 1
     return end, bs[sep_index + 1 : end]
 
 
+# Maps every possible token to its decoder, or to `None` if it is invalid.
+_DECODERS = [None] * 256
+_DECODERS[_INT] = _decode_int
+_DECODERS[_LIST] = _decode_list
+_DECODERS[_DICT] = _decode_dict
+_DECODERS[_ZERO : _NINE + 1] = [_decode_bytes] * (_NINE - _ZERO + 1)
+
+
 def decode_from(bs, start):
     try:
-        token = bs[start]
+        decoder = _DECODERS[bs[start]]
     except IndexError as exc:
         raise ValueError(f"Expected more input at index {start}.") from exc
-    if token == ord("i"):
-        return _decode_int(bs, start)
-    if token == ord("l"):
-        return _decode_list(bs, start)
-    if token == ord("d"):
-        return _decode_dict(bs, start)
-    if ord("0") <= token <= ord("9"):
-        return _decode_bytes(bs, start)
-    raise ValueError(f"Unexpected token at index {start}.")
+    if decoder is None:
+        raise ValueError(f"Unexpected token at index {start}.")
+    return decoder(bs, start)
 
 
 def decode(bs):
@@ -74,43 +82,55 @@ def decode(bs):
     raise ValueError(f"Leftover bytes at index {start}.")
 
 
-def raw_val(bs, key):
-    """Return the value associated with `key` in the encoded dictionary `bs`.
+def raw_span(bs, key):
+    """Return the bounds `(start, end)` of `key`'s value in the dictionary `bs`.
+
+    Unlike `raw_val`, this doesn't copy the value; use it with a `memoryview`
+    when the value is large and only read once.
 
     Raise `KeyError` if `key` is not a key of `bs`.
     """
     start = 1
-    while start < len(bs) and bs[start] != ord("e"):
+    while start < len(bs) and bs[start] != _END:
         start, curr_key = _decode_bytes(bs, start)
         next_start, _ = decode_from(bs, start)
         if curr_key == key:
-            return bs[start:next_start]
+            return start, next_start
         start = next_start
     raise KeyError(key)
 
 
+def raw_val(bs, key):
+    """Return the value associated with `key` in the encoded dictionary `bs`.
+
+    Raise `KeyError` if `key` is not a key of `bs`.
+    """
+    start, end = raw_span(bs, key)
+    return bs[start:end]
+
+
 def _encode_int(buf, n):
-    buf.write(b"i%de" % n)
+    buf += b"i%de" % n
 
 
 def _encode_list(buf, l):  # noqa: E741
-    buf.write(b"l")
+    buf += b"l"
     for obj in l:
         _encode(buf, obj)
-    buf.write(b"e")
+    buf += b"e"
 
 
 def _encode_dict(buf, d):
-    buf.write(b"d")
-    for key, value in sorted(d.items()):
+    buf += b"d"
+    for key in sorted(d):
         _encode_bytes(buf, key)
-        _encode(buf, value)
-    buf.write(b"e")
+        _encode(buf, d[key])
+    buf += b"e"
 
 
 def _encode_bytes(buf, bs):
-    buf.write(b"%d:" % len(bs))
-    buf.write(bs)
+    buf += b"%d:" % len(bs)
+    buf += bs
 
 
 def _encode(buf, obj):
@@ -131,6 +151,6 @@ def encode(obj):
 
     Raise `TypeError` if `obj` is not representable in BEncoding.
     """
-    buf = io.BytesIO()
+    buf = bytearray()
     _encode(buf, obj)
-    return buf.getvalue()
+    return bytes(buf)
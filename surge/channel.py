@@ -11,14 +11,26 @@ class Channel(asyncio.Queue):
     def __init__(self, maxsize=0):
         super().__init__(maxsize)
         self._sentinel = object()
+        self._closed = False
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        if (item := await self.get()) is self._sentinel:
-            raise StopAsyncIteration
-        return item
+        if not self._closed and (item := await self.get()) is not self._sentinel:
+            return item
+        self._closed = True
+        raise StopAsyncIteration
+
+    def drain_nowait(self):
+        """Return the list of items that can be received without waiting."""
+        items = []
+        while not self._closed and not self.empty():
+            if (item := self.get_nowait()) is self._sentinel:
+                self._closed = True
+            else:
+                items.append(item)
+        return items
 
     async def close(self):
         await self.put(self._sentinel)
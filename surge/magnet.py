@@ -18,22 +18,26 @@ import secrets
 import sys
 import urllib.parse
 
-try:
-    import uvloop
-except ImportError:
-    pass
-else:
-    uvloop.install()
-
 from . import bencoding
 from . import messages
-from .stream import open_stream
+from .stream import Watchdog, open_stream
 from .tracker import Trackers
 
 
 # Length of a metadata piece.
 PIECE_LENGTH = 2**14
 
+# Upper bound on the metadata size that a peer may advertise; the buffer for the
+# metadata is allocated up front, so this is checked before trusting a peer.
+MAX_METADATA_SIZE = 2**24
+
+# Number of metadata pieces to request from a peer at once.
+MAX_REQUESTS = 8
+
+# Number of seconds to wait for the next metadata piece before giving up on a
+# peer.
+PEER_TIMEOUT = 30
+
 
 def parse(magnet_uri):
     """Return `(info_hash, announce_list)` of a magnet URI.
@@ -60,10 +64,6 @@ def parse(magnet_uri):
     return info_hash, announce_list
 
 
-def valid_raw_info(info_hash, raw_info):
-    return hashlib.sha1(raw_info).digest() == info_hash
-
-
 def assemble_raw_metadata(announce_list, raw_info):
     # We can't just decode and re-encode, because the value associated with
     # the key `b"info"` needs to be preserved exactly.
@@ -81,33 +81,66 @@ def assemble_raw_metadata(announce_list, raw_info):
 
 async def download_from_peer(peer, info_hash, peer_id):
     async with open_stream(peer) as stream:
-        await stream.write(messages.Handshake(messages.EXTENSION_PROTOCOL_BIT, info_hash, peer_id))
-        received = await stream.read_handshake()
-        if not received.reserved & messages.EXTENSION_PROTOCOL_BIT:
-            raise ConnectionError("Extension protocol not supported.")
-        if received.info_hash != info_hash:
-            raise ConnectionError("Wrong 'info_hash'.")
-        await stream.write(messages.ExtensionHandshake())
-        while True:
-            received = await stream.read()
-            if isinstance(received, messages.ExtensionHandshake):
-                ut_metadata = received.ut_metadata
-                metadata_size = received.metadata_size
-                break
-        # Because the number of pieces is small, a simple stop-and-wait protocol
-        # is fast enough.
-        pieces = []
-        for i in range((metadata_size + PIECE_LENGTH - 1) // PIECE_LENGTH):
-            await stream.write(messages.MetadataRequest(i, ut_metadata=ut_metadata))
+        # Abort the connection if the peer stops sending metadata.
+        watchdog = Watchdog(PEER_TIMEOUT, stream.abort)
+        watchdog.reset()
+        try:
+            await stream.write(messages.Handshake(messages.EXTENSION_PROTOCOL_BIT, info_hash, peer_id))
+            received = await stream.read_handshake()
+            if not received.reserved & messages.EXTENSION_PROTOCOL_BIT:
+                raise ConnectionError("Extension protocol not supported.")
+            if received.info_hash != info_hash:
+                raise ConnectionError("Wrong 'info_hash'.")
+            await stream.write(messages.ExtensionHandshake())
             while True:
                 received = await stream.read()
-                if isinstance(received, messages.MetadataData):
-                    pieces.append(received.data)
+                if isinstance(received, messages.ExtensionHandshake):
+                    ut_metadata = received.ut_metadata
+                    metadata_size = received.metadata_size
                     break
-        raw_info = b"".join(pieces)
-        if valid_raw_info(info_hash, raw_info):
-            return raw_info
-        raise ConnectionError("Invalid data.")
+            if metadata_size is None or not 0 < metadata_size <= MAX_METADATA_SIZE:
+                raise ConnectionError("Invalid 'metadata_size'.")
+            # Keep a window of requests open, so that a slow peer costs one round
+            # trip per window instead of one per piece. Pieces may arrive in any
+            # order; each is hashed as soon as all of the pieces before it are in,
+            # so that validation overlaps with waiting for the rest.
+            pieces = (metadata_size + PIECE_LENGTH - 1) // PIECE_LENGTH
+            raw_info = bytearray(metadata_size)
+            info_hasher = hashlib.sha1()
+            hashed = 0
+            requested = min(pieces, MAX_REQUESTS)
+            unhashed = set()
+            await stream.write_many([messages.MetadataRequest(i, ut_metadata=ut_metadata) for i in range(requested)])
+            while hashed < pieces:
+                received = await stream.read()
+                if not isinstance(received, messages.MetadataData):
+                    continue
+                i = received.index
+                # The digest can only be checked at the end, but a piece that
+                # doesn't fit the advertised layout is already enough to give up on
+                # this peer.
+                length = min(PIECE_LENGTH, metadata_size - i * PIECE_LENGTH)
+                outstanding = hashed <= i < requested
+                duplicate = i in unhashed
+                wrong_size = received.total_size != metadata_size
+                wrong_length = len(received.data) != length
+                if not outstanding or duplicate or wrong_size or wrong_length:
+                    raise ConnectionError("Invalid data.")
+                watchdog.reset()
+                raw_info[i * PIECE_LENGTH : i * PIECE_LENGTH + length] = received.data
+                unhashed.add(i)
+                while hashed in unhashed:
+                    unhashed.remove(hashed)
+                    info_hasher.update(memoryview(raw_info)[hashed * PIECE_LENGTH : (hashed + 1) * PIECE_LENGTH])
+                    hashed += 1
+                if requested < pieces:
+                    await stream.write(messages.MetadataRequest(requested, ut_metadata=ut_metadata))
+                    requested += 1
+            if info_hasher.digest() == info_hash:
+                return raw_info
+            raise ConnectionError("Invalid data.")
+        finally:
+            watchdog.cancel()
 
 
 async def download_from_peer_loop(result, trackers, info_hash, peer_id):
@@ -125,7 +158,7 @@ async def download_from_peer_loop(result, trackers, info_hash, peer_id):
 async def download(info_hash, peer_id, announce_list, max_peers):
     """Download the `.torrent` file corresponding to `info_hash`."""
     async with Trackers(info_hash, peer_id, announce_list, max_peers) as trackers:
-        result = asyncio.get_event_loop().create_future()
+        result = asyncio.get_running_loop().create_future()
         tasks = set()
         try:
             for _ in range(max_peers):
@@ -135,10 +168,19 @@ async def download(info_hash, peer_id, announce_list, max_peers):
         finally:
             for task in tasks:
                 task.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
+            if tasks:
+                await asyncio.wait(tasks)
 
 
 def main(args):
+    # Installed here rather than at import time, so that importing the module
+    # as a library doesn't change the event loop policy of the caller.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
     info_hash, announce_list = parse(args.uri)
     peer_id = secrets.token_bytes(20)
     raw_metadata = asyncio.run(download(info_hash, peer_id, announce_list, args.peers))
@@ -19,6 +19,14 @@ from . import bencoding
 # The bit in `Handshake.reserved` that indicates extension protocol support.
 EXTENSION_PROTOCOL_BIT = 1 << 20
 
+# Precompiled formats of the messages that are exchanged once per block.
+_HAVE = struct.Struct(">LBL")
+_REQUEST = struct.Struct(">LBLLL")  # Also the layout of `Cancel`.
+_BLOCK_HEADER = struct.Struct(">LBLL")
+
+# Maps every byte to the offsets of its set bits, most significant bit first.
+_SET_BITS = [tuple(offset for offset in range(8) if b & 1 << (7 - offset)) for b in range(256)]
+
 
 @dataclasses.dataclass
 class Handshake:
@@ -103,17 +111,19 @@ class NotInterested:
 
 @dataclasses.dataclass
 class Have:
+    __slots__ = ("index",)
+
     prefix: ClassVar[int] = 5
     value: ClassVar[int] = 4
     index: int
 
     @classmethod
     def from_bytes(cls, raw_message):
-        _, _, index = struct.unpack(">LBL", raw_message)
+        _, _, index = _HAVE.unpack(raw_message)
         return cls(index)
 
     def to_bytes(self):
-        return struct.pack(">LBL", self.prefix, self.value, self.index)
+        return _HAVE.pack(self.prefix, self.value, self.index)
 
 
 @dataclasses.dataclass
@@ -123,8 +133,7 @@ class Bitfield:
 
     @classmethod
     def from_bytes(cls, raw_message):
-        _, _, bitfield = struct.unpack(f">LB{len(raw_message) - 5}s", raw_message)
-        return cls(bitfield)
+        return cls(raw_message[5:])
 
     @classmethod
     def from_indices(cls, indices, length):
@@ -134,24 +143,17 @@ class Bitfield:
         return cls(bytes(result))
 
     def to_bytes(self):
-        n = len(self.bitfield)
-        return struct.pack(f">LB{n}s", n + 1, self.value, self.bitfield)
+        return struct.pack(">LB", len(self.bitfield) + 1, self.value) + self.bitfield
 
     def to_indices(self):
-        result = set()
-        i = 0
-        for b in self.bitfield:
-            mask = 1 << 7
-            while mask:
-                if b & mask:
-                    result.add(i)
-                mask >>= 1
-                i += 1
-        return result
+        starts = range(0, 8 * len(self.bitfield), 8)
+        return {start + offset for start, b in zip(starts, self.bitfield) if b for offset in _SET_BITS[b]}
 
 
 @dataclasses.dataclass
 class Request:
+    __slots__ = ("index", "begin", "length")
+
     prefix: ClassVar[int] = 13
     value: ClassVar[int] = 6
     index: int
@@ -164,15 +166,17 @@ class Request:
 
     @classmethod
     def from_bytes(cls, raw_message):
-        _, _, index, begin, length = struct.unpack(">LBLLL", raw_message)
+        _, _, index, begin, length = _REQUEST.unpack(raw_message)
         return cls(index, begin, length)
 
     def to_bytes(self):
-        return struct.pack(">LBLLL", self.prefix, self.value, self.index, self.begin, self.length)
+        return _REQUEST.pack(self.prefix, self.value, self.index, self.begin, self.length)
 
 
 @dataclasses.dataclass
 class Block:
+    __slots__ = ("index", "begin", "data")
+
     value: ClassVar[int] = 7
     index: int
     begin: int
@@ -184,12 +188,13 @@ class Block:
 
     @classmethod
     def from_bytes(cls, raw_message):
-        _, _, index, begin, data = struct.unpack(f">LBLL{len(raw_message) - 13}s", raw_message)
-        return cls(index, begin, data)
+        _, _, index, begin = _BLOCK_HEADER.unpack_from(raw_message)
+        # A view instead of a slice, because the data is copied into the piece's
+        # buffer right away anyway.
+        return cls(index, begin, memoryview(raw_message)[13:])
 
     def to_bytes(self):
-        n = len(self.data)
-        return struct.pack(f">LBLL{n}s", n + 9, self.value, self.index, self.begin, self.data)
+        return _BLOCK_HEADER.pack(len(self.data) + 9, self.value, self.index, self.begin) + self.data
 
 
 @dataclasses.dataclass
@@ -206,11 +211,11 @@ class Cancel:
 
     @classmethod
     def from_bytes(cls, raw_message):
-        _, _, index, begin, length = struct.unpack(">LBLLL", raw_message)
+        _, _, index, begin, length = _REQUEST.unpack(raw_message)
         return cls(index, begin, length)
 
     def to_bytes(self):
-        return struct.pack(">LBLLL", self.prefix, self.value, self.index, self.begin, self.length)
+        return _REQUEST.pack(self.prefix, self.value, self.index, self.begin, self.length)
 
 
 @dataclasses.dataclass
@@ -242,8 +247,7 @@ class ExtensionHandshake(ExtensionProtocol):
         if self.metadata_size is not None:
             d[b"metadata_size"] = self.metadata_size
         payload = bencoding.encode(d)
-        n = len(payload)
-        return struct.pack(f">LBB{n}s", n + 2, self.value, self.extension_value, payload)
+        return struct.pack(">LBB", len(payload) + 2, self.value, self.extension_value) + payload
 
     @classmethod
     def from_bytes(cls, raw_message):
@@ -292,8 +296,7 @@ class MetadataRequest(MetadataProtocol):
 
     def to_bytes(self):
         payload = bencoding.encode({b"msg_type": self.metadata_value, b"piece": self.index})
-        n = len(payload)
-        return struct.pack(f">LBB{n}s", n + 2, self.value, self.extension_value, payload)
+        return struct.pack(">LBB", len(payload) + 2, self.value, self.extension_value) + payload
 
 
 @dataclasses.dataclass
@@ -310,9 +313,8 @@ class MetadataData(MetadataProtocol):
 
     def to_bytes(self):
         payload = bencoding.encode({b"msg_type": self.metadata_value, b"piece": self.index, b"total_size": self.total_size})
-        m = len(payload)
-        n = len(self.data)
-        return struct.pack(f">LBB{m}s{n}s", m + n + 2, self.value, self.extension_value, payload, self.data)
+        header = struct.pack(">LBB", len(payload) + len(self.data) + 2, self.value, self.extension_value)
+        return b"".join((header, payload, self.data))
 
 
 @dataclasses.dataclass
@@ -327,8 +329,7 @@ class MetadataReject(MetadataProtocol):
 
     def to_bytes(self):
         payload = bencoding.encode({b"msg_type": self.metadata_value, b"piece": self.index})
-        n = len(payload)
-        return struct.pack(f">LBB{n}s", n + 2, self.value, self.extension_value, payload)
+        return struct.pack(">LBB", len(payload) + 2, self.value, self.extension_value) + payload
 
 
 _MESSAGE_TYPE = {
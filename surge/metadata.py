@@ -37,6 +37,11 @@ class Piece:
     length: int
     hash: bytes  # SHA-1 digest of the piece's data.
 
+    def __hash__(self):
+        # Pieces are used as set elements and dictionary keys everywhere; the
+        # index alone identifies a piece, so don't hash all of the fields.
+        return hash(self.index)
+
 
 def valid_piece_data(piece, data):
     """Check whether `data`'s SHA-1 digest is equal to `piece.hash`."""
@@ -63,12 +68,14 @@ class Chunk:
             f.seek(self.begin - self.file.begin)
             return f.read(self.length)
 
-    def write(self, folder, data):
-        """Write the chunk's data to the file system."""
-        with (folder / self.file.path).open("rb+") as f:
-            f.seek(self.begin - self.file.begin)
-            begin = self.begin - self.piece.begin
-            f.write(data[begin : begin + self.length])
+    def write(self, f, data):
+        """Write the chunk's data to `f`, an open binary file object for `file`.
+
+        `data` is the data of the whole piece.
+        """
+        f.seek(self.begin - self.file.begin)
+        begin = self.begin - self.piece.begin
+        f.write(memoryview(data)[begin : begin + self.length])
 
 
 def make_chunks(pieces, files):
@@ -114,11 +121,17 @@ class Block:
     begin: int  # Relative offset.
     length: int
 
+    def __hash__(self):
+        return hash((self.piece.index, self.begin))
+
+
+# Length of a block; only the last block of a piece can be shorter.
+BLOCK_LENGTH = 2**14
+
 
 def yield_blocks(piece):
-    block_length = 2**14
-    for begin in range(0, piece.length, block_length):
-        yield Block(piece, begin, min(block_length, piece.length - begin))
+    for begin in range(0, piece.length, BLOCK_LENGTH):
+        yield Block(piece, begin, min(BLOCK_LENGTH, piece.length - begin))
 
 
 @dataclasses.dataclass
@@ -177,4 +190,7 @@ class Metadata:
             i += 1
             begin = end
 
-        return cls(hashlib.sha1(bencoding.raw_val(raw_metadata, b"info")).digest(), announce_list, pieces, files)
+        start, end = bencoding.raw_span(raw_metadata, b"info")
+        info_hash = hashlib.sha1(memoryview(raw_metadata)[start:end]).digest()
+
+        return cls(info_hash, announce_list, pieces, files)
@@ -11,13 +11,14 @@ import asyncio
 import collections
 import enum
 import functools
+import hashlib
 import os
 import random
 
-from .metadata import Block, make_chunks, valid_piece_data, yield_blocks
+from .metadata import BLOCK_LENGTH, Block, make_chunks, yield_blocks
 from . import messages
 from .channel import Channel
-from .stream import open_stream
+from .stream import Watchdog, open_stream
 from .tracker import Trackers
 
 
@@ -29,28 +30,64 @@ class State(enum.IntEnum):
     PASSIVE = enum.auto()
 
 
+# Number of seconds to wait for a requested block before giving up on a peer.
+REQUEST_TIMEOUT = 30
+
+
 class Progress:
+    __slots__ = ("_piece", "_missing", "_data", "_view", "_hash", "_hashed", "_unhashed")
+
     def __init__(self, piece, blocks):
-        self._missing_blocks = set(blocks)
+        self._piece = piece
+        # Bit `i` is set if the block with index `i` is missing.
+        self._missing = (1 << len(blocks)) - 1
         self._data = bytearray(piece.length)
+        # Blocks are written and hashed through a single view of `_data`; its
+        # slices have a fixed length, so writes never take the resize path.
+        self._view = memoryview(self._data)
+        # The piece's SHA-1 digest is computed incrementally, as the blocks
+        # arrive; blocks that arrive out of order wait in `_unhashed` until the
+        # gap before them is filled.
+        self._hash = hashlib.sha1()
+        self._hashed = 0
+        self._unhashed = {}
 
     @property
     def done(self):
-        return not self._missing_blocks
+        return not self._missing
 
     @property
-    def data(self):
-        return bytes(self._data)
+    def valid(self):
+        """Whether the data's SHA-1 digest is equal to the piece's hash."""
+        return self._hash.digest() == self._piece.hash
+
+    def finish(self):
+        """Stop accepting blocks and return the piece's data.
+
+        The buffer is handed over without copying it into `bytes`; `add` must
+        not be called afterwards.
+        """
+        self._view.release()
+        return self._data
 
     def add(self, block, data):
-        self._missing_blocks.discard(block)
-        self._data[block.begin : block.begin + block.length] = data
+        bit = 1 << block.begin // BLOCK_LENGTH
+        if not self._missing & bit:
+            return
+        self._missing ^= bit
+        view = self._view
+        view[block.begin : block.begin + block.length] = data
+        self._unhashed[block.begin] = block.length
+        while (length := self._unhashed.pop(self._hashed, None)) is not None:
+            self._hash.update(view[self._hashed : self._hashed + length])
+            self._hashed += length
 
 
 class Queue:
     def __init__(self):
         self._progress = {}
-        self._requested = set()
+        # A dictionary with `None` values is used as an insertion-ordered set.
+        self._requested = {}
         self._queue = collections.deque()
 
     @property
@@ -60,18 +97,32 @@ class Queue:
 
     def add_piece(self, piece):
         """Add `piece` to the download queue."""
-        blocks = set(yield_blocks(piece))
+        blocks = tuple(yield_blocks(piece))
         self._progress[piece] = Progress(piece, blocks)
+        # Blocks are popped from the right, so this requests them in order,
+        # which lets `Progress` hash them as soon as they arrive.
         self._queue.extendleft(blocks)
 
-    def reset_progress(self):
-        """Reset the progress of all pieces in the download queue."""
-        in_progress = tuple(self._progress)
-        self._progress.clear()
+    def cancel_requests(self):
+        """Put the blocks of all open requests back into the block queue.
+
+        Blocks that were already delivered are kept.
+        """
+        # Re-request the blocks in the order of the original requests.
+        self._queue.extend(reversed(self._requested))
         self._requested.clear()
-        self._queue.clear()
-        for piece in in_progress:
-            self.add_piece(piece)
+
+    def drop_piece(self, piece):
+        """Remove `piece` from the download queue.
+
+        Return the blocks of `piece` that were requested but not delivered.
+        """
+        self._progress.pop(piece, None)
+        requested = [block for block in self._requested if block.piece == piece]
+        for block in requested:
+            del self._requested[block]
+        self._queue = collections.deque(block for block in self._queue if block.piece != piece)
+        return requested
 
     def get_block(self):
         """Return a block to download next.
@@ -79,7 +130,7 @@ class Queue:
         Raise `IndexError` if the block queue is empty.
         """
         block = self._queue.pop()
-        self._requested.add(block)
+        self._requested[block] = None
         return block
 
     def put_block(self, block, data):
@@ -89,15 +140,15 @@ class Queue:
         """
         if block not in self._requested:
             return None
-        self._requested.remove(block)
+        del self._requested[block]
         piece = block.piece
         progress = self._progress[piece]
         progress.add(block, data)
         if not progress.done:
             return None
-        data = self._progress.pop(piece).data
-        if valid_piece_data(piece, data):
-            return (piece, data)
+        self._progress.pop(piece)
+        if progress.valid:
+            return (piece, progress.finish())
         raise ValueError("Invalid data.")
 
 
@@ -107,52 +158,83 @@ async def download_from_peer(torrent, peer, info_hash, peer_id, pieces, max_requ
         received = await stream.read_handshake()
         if received.info_hash != info_hash:
             raise ValueError("Wrong 'info_hash'.")
-        available = set()
         # Wait for the peer to tell us which pieces it has. This is not mandated
         # by the specification, but makes requesting pieces much easier.
         while True:
             received = await stream.read()
             if isinstance(received, messages.Have):
-                available.add(pieces[received.index])
+                torrent.add_available(peer, (pieces[received.index],))
                 break
             if isinstance(received, messages.Bitfield):
-                for i in received.to_indices():
-                    available.add(pieces[i])
+                torrent.add_available(peer, (pieces[i] for i in received.to_indices()))
                 break
         state = State.CHOKED
         queue = Queue()
-        while True:
-            if state is State.CHOKED:
-                await stream.write(messages.Interested())
-                state = State.INTERESTED
-            elif state is State.UNCHOKED and queue.requested < max_requests:
-                try:
-                    block = queue.get_block()
-                except IndexError:
-                    try:
-                        piece = torrent.get_piece(peer, available)
-                    except IndexError:
-                        state = State.PASSIVE
-                    else:
-                        queue.add_piece(piece)
+        # Abort the connection if the peer sits on our requests, so that its
+        # pieces become available to other peers again.
+        watchdog = Watchdog(REQUEST_TIMEOUT, stream.abort)
+        try:
+            while True:
+                if state is State.CHOKED:
+                    await stream.write(messages.Interested())
+                    state = State.INTERESTED
+                elif state is State.UNCHOKED and queue.requested < max_requests:
+                    # Fill all free request slots at once, so that the requests
+                    # go out in a single write.
+                    requests = []
+                    while queue.requested < max_requests:
+                        try:
+                            block = queue.get_block()
+                        except IndexError:
+                            try:
+                                piece = torrent.get_piece(peer)
+                            except IndexError:
+                                state = State.PASSIVE
+                                break
+                            queue.add_piece(piece)
+                        else:
+                            requests.append(messages.Request.from_block(block))
+                    if requests:
+                        watchdog.reset()
+                        await stream.write_many(requests)
                 else:
-                    await stream.write(messages.Request.from_block(block))
-            else:
-                received = await stream.read()
-                if isinstance(received, messages.Choke):
-                    queue.reset_progress()
-                    state = State.CHOKED
-                elif isinstance(received, messages.Unchoke):
-                    if state is not State.PASSIVE:
-                        state = State.UNCHOKED
-                elif isinstance(received, messages.Have):
-                    available.add(pieces[received.index])
-                    if state is State.PASSIVE:
-                        state = State.UNCHOKED
-                elif isinstance(received, messages.Block):
-                    result = queue.put_block(Block(pieces[received.index], received.begin, len(received.data)), received.data)
-                    if result is not None:
-                        await torrent.put_piece(peer, *result)
+                    received = await stream.read()
+                    message_type = type(received)
+                    # Ordered by expected frequency; `Block` dominates once the
+                    # download is underway.
+                    if message_type is messages.Block:
+                        piece = pieces[received.index]
+                        block = Block(piece, received.begin, len(received.data))
+                        if torrent.is_missing(piece):
+                            result = queue.put_block(block, received.data)
+                            if result is not None:
+                                # Only time spent waiting on the peer counts;
+                                # `put_piece` blocks while the writer is behind.
+                                watchdog.pause()
+                                await torrent.put_piece(peer, *result)
+                        else:
+                            # Endgame: another peer finished this piece first,
+                            # so cancel our remaining requests for it.
+                            cancelled = [other for other in queue.drop_piece(piece) if other != block]
+                            if cancelled:
+                                await stream.write_many([messages.Cancel.from_block(other) for other in cancelled])
+                        if queue.requested:
+                            watchdog.reset()
+                        else:
+                            watchdog.pause()
+                    elif message_type is messages.Have:
+                        torrent.add_available(peer, (pieces[received.index],))
+                        if state is State.PASSIVE:
+                            state = State.UNCHOKED
+                    elif message_type is messages.Choke:
+                        queue.cancel_requests()
+                        watchdog.pause()
+                        state = State.CHOKED
+                    elif message_type is messages.Unchoke:
+                        if state is not State.PASSIVE:
+                            state = State.UNCHOKED
+        finally:
+            watchdog.cancel()
 
 
 async def download_from_peer_loop(torrent, trackers, info_hash, peer_id, pieces, max_requests):
@@ -170,8 +252,15 @@ async def download_from_peer_loop(torrent, trackers, info_hash, peer_id, pieces,
 class Torrent:
     def __init__(self, pieces, missing_pieces, results):
         self._missing_pieces = set(missing_pieces)
+        # Missing pieces that no peer is currently downloading; kept up to date
+        # incrementally so that `get_piece` doesn't have to recompute it.
+        self._unborrowed_pieces = set(missing_pieces)
         self._peer_to_pieces = {}
-        self._piece_to_peers = collections.defaultdict(set)
+        self._peer_to_available = {}
+        # Number of connected peers that have each piece.
+        self._availability = collections.Counter()
+        # Number of peers that are downloading each piece.
+        self._borrowers = collections.Counter()
         self._pieces = pieces
         self._results = results
         # This check is necessary because `put_piece` is never called if there
@@ -194,15 +283,29 @@ class Torrent:
         """The number of connected peers."""
         return len(self._peer_to_pieces)
 
-    def get_piece(self, peer, available):
+    def is_missing(self, piece):
+        """Whether `piece` still needs to be downloaded."""
+        return piece in self._missing_pieces
+
+    def get_piece(self, peer):
         """Return a piece to download next.
 
+        Pieces that no other peer is downloading are preferred; among those, one
+        of the rarest pieces is chosen.
+
         Raise `IndexError` if there are no additional pieces to download.
         """
-        pool = self._missing_pieces & (available - self._peer_to_pieces[peer])
-        piece = random.choice(tuple(pool - set(self._piece_to_peers) or pool))
-        self._peer_to_pieces[peer].add(piece)
-        self._piece_to_peers[piece].add(peer)
+        available = self._peer_to_available[peer]
+        borrowed = self._peer_to_pieces[peer]
+        pool = self._unborrowed_pieces & available or self._missing_pieces & (available - borrowed)
+        if not pool:
+            raise IndexError("No pieces to download.")
+        availability = self._availability
+        rarest = min(availability[piece] for piece in pool)
+        piece = random.choice([piece for piece in pool if availability[piece] == rarest])
+        self._unborrowed_pieces.discard(piece)
+        borrowed.add(piece)
+        self._borrowers[piece] += 1
         return piece
 
     async def put_piece(self, peer, piece, data):
@@ -211,21 +314,36 @@ class Torrent:
             return
         self._missing_pieces.remove(piece)
         self._peer_to_pieces[peer].remove(piece)
-        self._piece_to_peers[piece].remove(peer)
-        if not self._piece_to_peers[piece]:
-            self._piece_to_peers.pop(piece)
+        self._borrowers[piece] -= 1
+        if not self._borrowers[piece]:
+            self._borrowers.pop(piece)
         await self._results.put((piece, data))
         if not self._missing_pieces:
             await self._results.close()
 
+    def add_available(self, peer, pieces):
+        """Record that `peer` has `pieces`."""
+        available = self._peer_to_available[peer]
+        for piece in pieces:
+            if piece not in available:
+                available.add(piece)
+                self._availability[piece] += 1
+
     def peer_connected(self, peer):
         self._peer_to_pieces[peer] = set()
+        self._peer_to_available[peer] = set()
 
     def peer_disconnected(self, peer):
+        for piece in self._peer_to_available.pop(peer):
+            self._availability[piece] -= 1
+            if not self._availability[piece]:
+                self._availability.pop(piece)
         for piece in self._peer_to_pieces.pop(peer):
-            self._piece_to_peers[piece].remove(peer)
-            if not self._piece_to_peers[piece]:
-                self._piece_to_peers.pop(piece)
+            self._borrowers[piece] -= 1
+            if not self._borrowers[piece]:
+                self._borrowers.pop(piece)
+                if piece in self._missing_pieces:
+                    self._unborrowed_pieces.add(piece)
 
 
 async def print_progress(torrent, trackers):
@@ -266,6 +384,26 @@ def build_file_tree(folder, files):
             f.truncate(file.length)
 
 
+def write_pieces(handles, folder, chunks, results):
+    """Write the downloaded pieces in `results` to the file system.
+
+    The elements of `results` are pairs `(piece, data)`, and `chunks` maps each
+    piece to its `Chunk`s. Open file objects are cached in the dictionary
+    `handles`, so that every file is only opened once per download; closing them
+    is up to the caller.
+    """
+    for piece, data in results:
+        for chunk in chunks[piece]:
+            if (f := handles.get(chunk.file)) is None:
+                f = handles[chunk.file] = (folder / chunk.file.path).open("rb+")
+            chunk.write(f, data)
+
+
+def close_files(files):
+    for f in files:
+        f.close()
+
+
 async def download(metadata, folder, peer_id, missing_pieces, max_peers, max_requests):
     """Download the files represented by `metadata` to the file system."""
     info_hash = metadata.info_hash
@@ -274,20 +412,32 @@ async def download(metadata, folder, peer_id, missing_pieces, max_peers, max_req
         results = Channel(max_peers)
         torrent = Torrent(pieces, missing_pieces, results)
         tasks = set()
+        loop = asyncio.get_running_loop()
+        handles = {}
+        # The write that is currently running in the thread pool, if any.
+        write = None
         try:
             for _ in range(max_peers):
                 tasks.add(asyncio.create_task(download_from_peer_loop(torrent, trackers, info_hash, peer_id, pieces, max_requests)))
             tasks.add(asyncio.create_task(print_progress(torrent, trackers)))
-            loop = asyncio.get_running_loop()
             files = metadata.files
             # Delegate to a thread pool because asyncio has no direct support for
             # asynchronous file system operations.
             await loop.run_in_executor(None, functools.partial(build_file_tree, folder, files))
             chunks = make_chunks(pieces, files)
-            async for piece, data in results:
-                for chunk in chunks[piece]:
-                    await loop.run_in_executor(None, functools.partial(chunk.write, folder, data))
+            async for result in results:
+                # Write all pieces that are ready in a single trip to the thread
+                # pool, instead of waking up the writer once per piece.
+                batch = [result, *results.drain_nowait()]
+                write = loop.run_in_executor(None, functools.partial(write_pieces, handles, folder, chunks, batch))
+                # Shielded, because cancelling the future doesn't stop the
+                # thread, which still uses `handles`.
+                await asyncio.shield(write)
         finally:
             for task in tasks:
                 task.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
+            if tasks:
+                await asyncio.wait(tasks)
+            if write is not None:
+                await asyncio.wait((write,))
+            await loop.run_in_executor(None, functools.partial(close_files, list(handles.values())))
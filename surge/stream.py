@@ -28,6 +28,54 @@ class Stream:
         self._writer.write(message.to_bytes())
         await self._writer.drain()
 
+    async def write_many(self, batch):
+        self._writer.writelines([message.to_bytes() for message in batch])
+        await self._writer.drain()
+
+    def abort(self):
+        """Close the connection immediately, failing any pending reads."""
+        self._writer.transport.abort()
+
+
+class Watchdog:
+    """Call `callback` if `reset` isn't called for `timeout` seconds.
+
+    Resetting only moves the deadline; the timer is rescheduled lazily when it
+    fires, so `reset` is cheap enough to call for every received message.
+    """
+
+    def __init__(self, timeout, callback):
+        self._loop = asyncio.get_running_loop()
+        self._timeout = timeout
+        self._callback = callback
+        self._deadline = None
+        self._handle = None
+
+    def reset(self):
+        """Start the watchdog, or move its deadline forward."""
+        self._deadline = self._loop.time() + self._timeout
+        if self._handle is None:
+            self._handle = self._loop.call_at(self._deadline, self._check)
+
+    def pause(self):
+        """Stop the watchdog until the next call to `reset`."""
+        self._deadline = None
+
+    def cancel(self):
+        self.pause()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self):
+        self._handle = None
+        if self._deadline is None:
+            return
+        if self._loop.time() < self._deadline:
+            self._handle = self._loop.call_at(self._deadline, self._check)
+        else:
+            self._callback()
+
 
 @contextlib.asynccontextmanager
 async def open_stream(peer):
@@ -104,7 +104,7 @@ class UDPTrackerProtocol(asyncio.DatagramProtocol):
         super().__init__()
 
         self._transport = None
-        self._closed = asyncio.get_event_loop().create_future()
+        self._closed = asyncio.get_running_loop().create_future()
 
         self._exception = None
         self._queue = collections.deque(maxlen=10)
@@ -321,7 +321,8 @@ class Trackers:
         tasks = self._trackers.values()
         for task in tasks:
             task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks:
+            await asyncio.wait(tasks)
 
     @property
     def connected_trackers(self):
@@ -52,3 +52,11 @@ class TestBencoding(unittest.TestCase):
         with self.subTest("KeyError is raised."):
             with self.assertRaises(KeyError):
                 bencoding.raw_val(b"d4:spaml1:a1:bee", b"eggs")
+
+    def test_raw_span(self):
+        x = b"d3:cow3:moo4:spam4:eggse"
+        start, end = bencoding.raw_span(x, b"spam")
+        self.assertEqual(x[start:end], b"4:eggs")
+
+        with self.assertRaises(KeyError):
+            bencoding.raw_span(x, b"eggs")
@@ -0,0 +1,19 @@
+import asyncio
+import unittest
+
+from surge.channel import Channel
+
+
+class TestChannel(unittest.TestCase):
+    def test_drain_nowait(self):
+        async def _main():
+            channel = Channel()
+            for i in range(3):
+                channel.put_nowait(i)
+            channel.close_nowait()
+            self.assertEqual(await channel.__anext__(), 0)
+            self.assertEqual(channel.drain_nowait(), [1, 2])
+            self.assertEqual(channel.drain_nowait(), [])
+            self.assertEqual([item async for item in channel], [])
+
+        asyncio.run(_main())
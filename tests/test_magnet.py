@@ -1,5 +1,8 @@
 import asyncio
+import hashlib
+import os
 import pathlib
+import random
 import unittest
 
 from surge.metadata import Metadata
@@ -7,6 +10,7 @@ from surge import bencoding
 from surge import magnet
 from surge import messages
 from surge.stream import Stream
+from surge.tracker import Peer
 
 from .tracker import serve_peers_http
 
@@ -50,6 +54,42 @@ async def upload(uploader_started, info_hash, raw_info):
         await server.serve_forever()
 
 
+async def download_metadata(info_hash, metadata_size, serve):
+    """Download metadata from a single uploader that answers through `serve`."""
+    peer_id = b"\x9b\x0e\xf4\x8e\x1a\xd0\x0c\x83\xeb\x1f\x12\x9e\x8bT\xc7\xa4\x06\xa2\x87\x1d"
+
+    async def _main(reader, writer):
+        try:
+            stream = Stream(reader, writer)
+            await stream.read_handshake()
+            await stream.write(messages.Handshake(messages.EXTENSION_PROTOCOL_BIT, info_hash, peer_id))
+            while True:
+                received = await stream.read()
+                if isinstance(received, messages.ExtensionHandshake):
+                    ut_metadata = received.ut_metadata
+                    break
+            await stream.write(messages.ExtensionHandshake(metadata_size=metadata_size))
+            await serve(stream, ut_metadata)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    server = await asyncio.start_server(_main, "127.0.0.1", 0)
+    async with server:
+        _, port = server.sockets[0].getsockname()
+        return await magnet.download_from_peer(Peer("127.0.0.1", port), info_hash, bytes(20))
+
+
+def metadata_pieces(raw_info, ut_metadata, indices):
+    result = []
+    for i in indices:
+        k = i * magnet.PIECE_LENGTH
+        result.append(messages.MetadataData(i, len(raw_info), raw_info[k : k + magnet.PIECE_LENGTH], ut_metadata=ut_metadata))
+    return result
+
+
 class TestMagnet(unittest.TestCase):
     def test_parse(self):
         with self.subTest("valid"):
@@ -95,3 +135,64 @@ class TestMagnet(unittest.TestCase):
             await asyncio.gather(*tasks, return_exceptions=True)
 
         asyncio.run(_main())
+
+    def test_download_from_peer(self):
+        # More pieces than fit into the request window; the last one is short.
+        raw_info = os.urandom((magnet.MAX_REQUESTS + 3) * magnet.PIECE_LENGTH + 123)
+        info_hash = hashlib.sha1(raw_info).digest()
+        last = (len(raw_info) - 1) // magnet.PIECE_LENGTH
+
+        with self.subTest("shuffled"):
+
+            async def serve(stream, ut_metadata):
+                rng = random.Random(0)
+                pending = []
+                while True:
+                    received = await stream.read()
+                    if isinstance(received, messages.MetadataRequest):
+                        pending.append(received.index)
+                        if len(pending) == 3 or received.index == last:
+                            rng.shuffle(pending)
+                            await stream.write_many(metadata_pieces(raw_info, ut_metadata, pending))
+                            pending.clear()
+
+            actual = asyncio.run(download_metadata(info_hash, len(raw_info), serve))
+            self.assertEqual(actual, raw_info)
+
+        invalid = {
+            "wrong length": lambda ut_metadata: [messages.MetadataData(0, len(raw_info), b"\x00", ut_metadata=ut_metadata)],
+            "duplicate": lambda ut_metadata: metadata_pieces(raw_info, ut_metadata, [1, 1]),
+            "not requested": lambda ut_metadata: metadata_pieces(raw_info, ut_metadata, [last]),
+        }
+
+        for name, replies in invalid.items():
+            with self.subTest(name):
+
+                async def serve(stream, ut_metadata):
+                    await stream.write_many(replies(ut_metadata))
+                    while True:
+                        await stream.read()
+
+                with self.assertRaises(ConnectionError):
+                    asyncio.run(download_metadata(info_hash, len(raw_info), serve))
+
+        with self.subTest("wrong hash"):
+
+            async def serve(stream, ut_metadata):
+                corrupted = bytes(len(raw_info))
+                while True:
+                    received = await stream.read()
+                    if isinstance(received, messages.MetadataRequest):
+                        await stream.write_many(metadata_pieces(corrupted, ut_metadata, [received.index]))
+
+            with self.assertRaises(ConnectionError):
+                asyncio.run(download_metadata(info_hash, len(raw_info), serve))
+
+        with self.subTest("too large"):
+
+            async def serve(stream, ut_metadata):
+                while True:
+                    await stream.read()
+
+            with self.assertRaises(ConnectionError):
+                asyncio.run(download_metadata(info_hash, magnet.MAX_METADATA_SIZE + 1, serve))
@@ -80,6 +80,15 @@ class TestMessages(unittest.TestCase):
     def test_to_indices(self):
         self.assertEqual(self.bitfield.to_indices(), {0})
 
+    def test_indices_round_trip(self):
+        self.assertEqual(messages.Bitfield.from_indices({0, 9, 16}, 17).bitfield, b"\x80\x40\x80")
+        for n in (8, 9, 17):
+            # Every bit position on its own, plus a few patterns that span bytes.
+            cases = [{i} for i in range(n)] + [set(), set(range(n)), set(range(0, n, 2)), set(range(1, n, 3))]
+            for indices in cases:
+                with self.subTest(n=n, indices=indices):
+                    self.assertEqual(messages.Bitfield.from_indices(indices, n).to_indices(), indices)
+
     def test_parse_handshake(self):
         self.assertEqual(messages.parse_handshake(self.handshake_reference), self.handshake)
 
@@ -1,20 +1,39 @@
 import asyncio
+import dataclasses
+import functools
+import hashlib
 import pathlib
 import unittest
+import unittest.mock
 
-from surge.metadata import Metadata, make_chunks, valid_piece_data
+from surge.metadata import BLOCK_LENGTH, Metadata, Piece, make_chunks, valid_piece_data, yield_blocks
 from surge import messages
-from surge.protocol import Torrent, download_from_peer_loop
+from surge import protocol
+from surge.protocol import Progress, Queue, Torrent, download_from_peer, download_from_peer_loop
 from surge.channel import Channel
 from surge.stream import Stream
-from surge.tracker import Trackers
+from surge.tracker import Peer, Trackers
 
 from .tracker import serve_peers_http
 
 
-async def upload(uploader_started, metadata, store):
+async def serve_blocks(store, stream, received):
+    if isinstance(received, messages.Request):
+        i = received.index
+        k = received.begin
+        await stream.write(messages.Block(i, k, store[i][k : k + received.length]))
+
+
+async def upload(uploader_started, metadata, store, serve=None):
+    """Upload `store` to every peer that connects.
+
+    Messages other than `Interested` are passed to `serve`, which defaults to
+    answering every `Request`.
+    """
     pieces = metadata.pieces
     info_hash = metadata.info_hash
+    if serve is None:
+        serve = functools.partial(serve_blocks, store)
 
     async def _main(reader, writer):
         stream = Stream(reader, writer)
@@ -31,10 +50,8 @@ async def upload(uploader_started, metadata, store):
                 break
             if isinstance(received, messages.Interested):
                 await stream.write(messages.Unchoke())
-            elif isinstance(received, messages.Request):
-                i = received.index
-                k = received.begin
-                await stream.write(messages.Block(i, k, store[i][k : k + received.length]))
+            else:
+                await serve(stream, received)
 
     server = await asyncio.start_server(_main, "127.0.0.1", 6881)
     async with server:
@@ -42,20 +59,126 @@ async def upload(uploader_started, metadata, store):
         await server.serve_forever()
 
 
+def load_example():
+    """Return the example torrent's metadata and the data of its pieces."""
+    folder = pathlib.Path() / "tests"
+    with (folder / "example.torrent").open("rb") as f:
+        metadata = Metadata.from_bytes(f.read())
+    chunks = make_chunks(metadata.pieces, metadata.files)
+    store = [b"".join(chunk.read(folder) for chunk in chunks[piece]) for piece in metadata.pieces]
+    return metadata, store
+
+
+async def start_uploader(metadata, store, serve=None):
+    uploader_started = asyncio.Event()
+    task = asyncio.create_task(upload(uploader_started, metadata, store, serve))
+    await uploader_started.wait()
+    return task
+
+
+async def stop(*tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Address of the uploader started by `upload`.
+UPLOADER = Peer("127.0.0.1", 6881)
+
+PEER_ID = b"\xad6n\x84\xb3a\xa4\xc1\xa1\xde\xd4H\x01J\xc0]\x1b\x88\x92I"
+
+
 class TestProtocol(unittest.TestCase):
+    def test_progress(self):
+        data = bytes(range(256)) * 160
+        piece = Piece(0, 0, len(data), hashlib.sha1(data).digest())
+        blocks = list(yield_blocks(piece))
+        progress = Progress(piece, blocks)
+        # Deliver the blocks out of order.
+        for block in reversed(blocks):
+            self.assertFalse(progress.done)
+            progress.add(block, data[block.begin : block.begin + block.length])
+        self.assertTrue(progress.done)
+        self.assertTrue(progress.valid)
+        self.assertEqual(progress.finish(), data)
+
+    def test_cancel_requests(self):
+        data = bytes(range(256)) * 256
+        piece = Piece(0, 0, len(data), hashlib.sha1(data).digest())
+        queue = Queue()
+        queue.add_piece(piece)
+        first = queue.get_block()
+        requested = [queue.get_block(), queue.get_block()]
+        self.assertIsNone(queue.put_block(first, data[first.begin : first.begin + first.length]))
+        # Choked: the open requests are re-queued, in order.
+        queue.cancel_requests()
+        self.assertEqual(queue.requested, 0)
+        self.assertEqual([queue.get_block(), queue.get_block()], requested)
+        # The block that was delivered before the choke isn't requested again.
+        remaining = [queue.get_block() for _ in range(len(list(yield_blocks(piece))) - 3)]
+        self.assertNotIn(first, remaining)
+        for block in requested + remaining:
+            result = queue.put_block(block, data[block.begin : block.begin + block.length])
+        self.assertEqual(result, (piece, data))
+
+    def test_drop_piece(self):
+        pieces = [Piece(i, 2**15 * i, 2**15, bytes(20)) for i in range(2)]
+        queue = Queue()
+        for piece in pieces:
+            queue.add_piece(piece)
+        requested = [queue.get_block() for _ in range(3)]
+        self.assertEqual(queue.drop_piece(pieces[0]), requested[:2])
+        self.assertEqual(queue.requested, 1)
+        # Only the blocks of the other piece are left.
+        self.assertEqual(queue.get_block().piece, pieces[1])
+        with self.assertRaises(IndexError):
+            queue.get_block()
+        with self.subTest("equal piece"):
+            # Pieces are compared by value, not by identity.
+            queue = Queue()
+            queue.add_piece(Piece(0, 0, 2**15, bytes(20)))
+            block = queue.get_block()
+            self.assertEqual(queue.drop_piece(Piece(0, 0, 2**15, bytes(20))), [block])
+            self.assertEqual(queue.requested, 0)
+            with self.assertRaises(IndexError):
+                queue.get_block()
+
+    def test_get_piece(self):
+        pieces = [Piece(i, i, 1, bytes(20)) for i in range(2)]
+        torrent = Torrent(pieces, pieces, Channel())
+        available = set(pieces)
+        for peer in ("a", "b", "c"):
+            torrent.peer_connected(peer)
+            torrent.add_available(peer, pieces)
+        # Pieces that nobody is downloading yet are preferred.
+        a = torrent.get_piece("a")
+        b = torrent.get_piece("b")
+        self.assertEqual({a, b}, available)
+        # Once every piece is borrowed, pieces are shared.
+        self.assertIn(torrent.get_piece("c"), available)
+        torrent.peer_disconnected("c")
+        torrent.peer_disconnected("a")
+        torrent.peer_connected("c")
+        torrent.add_available("c", pieces)
+        # The piece that "a" dropped is the only one that is free again.
+        self.assertEqual(torrent.get_piece("c"), a)
+
+    def test_get_piece_rarest_first(self):
+        pieces = [Piece(i, i, 1, bytes(20)) for i in range(3)]
+        torrent = Torrent(pieces, pieces, Channel())
+        for peer, available in [("a", pieces), ("b", pieces[1:]), ("c", pieces[2:])]:
+            torrent.peer_connected(peer)
+            torrent.add_available(peer, available)
+        self.assertEqual([torrent.get_piece("a") for _ in pieces], pieces)
+        # Shared pieces are also chosen rarest first.
+        self.assertEqual(torrent.get_piece("b"), pieces[1])
+        self.assertEqual(torrent.get_piece("b"), pieces[2])
+        with self.assertRaises(IndexError):
+            torrent.get_piece("b")
+
     def test_download(self):
-        folder = pathlib.Path() / "tests"
-        with (folder / "example.torrent").open("rb") as f:
-            raw_metadata = f.read()
-        metadata = Metadata.from_bytes(raw_metadata)
+        metadata, store = load_example()
         pieces = metadata.pieces
-        chunks = make_chunks(pieces, metadata.files)
-        store = []
-        for piece in pieces:
-            data = []
-            for chunk in chunks[piece]:
-                data.append(chunk.read(folder))
-            store.append(b"".join(data))
 
         async def _main():
             tracker_started = asyncio.Event()
@@ -66,7 +189,7 @@ class TestProtocol(unittest.TestCase):
             }
             await asyncio.gather(tracker_started.wait(), uploader_started.wait())
             info_hash = metadata.info_hash
-            peer_id = b"\xad6n\x84\xb3a\xa4\xc1\xa1\xde\xd4H\x01J\xc0]\x1b\x88\x92I"
+            peer_id = PEER_ID
             max_peers = 50
             async with Trackers(info_hash, peer_id, metadata.announce_list, max_peers) as trackers:
                 missing_pieces = set(pieces)
@@ -83,3 +206,98 @@ class TestProtocol(unittest.TestCase):
             await asyncio.gather(*tasks, return_exceptions=True)
 
         asyncio.run(_main())
+
+    @unittest.mock.patch.object(protocol, "REQUEST_TIMEOUT", 0.3)
+    def test_unresponsive_peer(self):
+        metadata, store = load_example()
+        pieces = metadata.pieces
+
+        async def ignore(stream, received):
+            pass
+
+        async def _main():
+            uploader = await start_uploader(metadata, store, ignore)
+            torrent = Torrent(pieces, pieces, Channel())
+            torrent.peer_connected(UPLOADER)
+            try:
+                # The peer unchokes us but never answers our requests.
+                with self.assertRaises(asyncio.IncompleteReadError):
+                    await asyncio.wait_for(download_from_peer(torrent, UPLOADER, metadata.info_hash, PEER_ID, pieces, 1), 5)
+            finally:
+                await stop(uploader)
+
+        asyncio.run(_main())
+
+    def test_endgame_cancel(self):
+        metadata, _ = load_example()
+        data = bytes(range(256)) * (4 * BLOCK_LENGTH // 256)
+        pieces = [Piece(0, 0, len(data), hashlib.sha1(data).digest())]
+        metadata = dataclasses.replace(metadata, pieces=pieces)
+        (piece,) = pieces
+        torrent = Torrent(pieces, pieces, Channel())
+        # Another peer is downloading the same piece.
+        torrent.peer_connected("other")
+        torrent.add_available("other", pieces)
+        torrent.get_piece("other")
+        requests = []
+        cancels = []
+
+        async def _main():
+            cancelled = asyncio.Event()
+
+            async def serve(stream, received):
+                if isinstance(received, messages.Request):
+                    requests.append(received)
+                    if len(requests) == 4:
+                        # The other peer wins the race, then the first block
+                        # arrives here.
+                        await torrent.put_piece("other", piece, data)
+                        await serve_blocks([data], stream, requests[0])
+                elif isinstance(received, messages.Cancel):
+                    cancels.append(received)
+                    if len(cancels) == 3:
+                        cancelled.set()
+
+            uploader = await start_uploader(metadata, [data], serve)
+            torrent.peer_connected(UPLOADER)
+            task = asyncio.create_task(download_from_peer(torrent, UPLOADER, metadata.info_hash, PEER_ID, pieces, 4))
+            try:
+                await asyncio.wait_for(cancelled.wait(), 5)
+            finally:
+                await stop(task, uploader)
+
+        asyncio.run(_main())
+        self.assertEqual(
+            [(c.index, c.begin, c.length) for c in cancels],
+            [(r.index, r.begin, r.length) for r in requests[1:]],
+        )
+
+    @unittest.mock.patch.object(protocol, "REQUEST_TIMEOUT", 0.3)
+    def test_slow_consumer(self):
+        metadata, store = load_example()
+        pieces = metadata.pieces
+
+        async def _main():
+            uploader = await start_uploader(metadata, store)
+            # The channel fills up, so `put_piece` waits for the consumer.
+            results = Channel(1)
+            torrent = Torrent(pieces, pieces, results)
+            torrent.peer_connected(UPLOADER)
+            task = asyncio.create_task(download_from_peer(torrent, UPLOADER, metadata.info_hash, PEER_ID, pieces, 1))
+
+            async def consume():
+                received = []
+                async for piece, data in results:
+                    await asyncio.sleep(0.5)
+                    received.append(piece)
+                return received
+
+            try:
+                received = await asyncio.wait_for(consume(), 10)
+                self.assertEqual(set(received), set(pieces))
+                # The peer was never dropped.
+                self.assertFalse(task.done())
+            finally:
+                await stop(task, uploader)
+
+        asyncio.run(_main())
@@ -0,0 +1,26 @@
+import asyncio
+import unittest
+
+from surge.stream import Watchdog
+
+
+class TestWatchdog(unittest.TestCase):
+    def test_watchdog(self):
+        async def _main():
+            fired = asyncio.Event()
+            watchdog = Watchdog(0.5, fired.set)
+            watchdog.reset()
+            # Resetting well within the timeout keeps the watchdog from firing,
+            # even though the total time exceeds it.
+            for _ in range(8):
+                await asyncio.sleep(0.1)
+                watchdog.reset()
+            self.assertFalse(fired.is_set())
+            watchdog.pause()
+            await asyncio.sleep(0.6)
+            self.assertFalse(fired.is_set())
+            watchdog.reset()
+            await asyncio.wait_for(fired.wait(), 5)
+            watchdog.cancel()
+
+        asyncio.run(_main())